@@ -1,73 +1,406 @@
 import streamlit as st
+import hashlib
 import requests
+import orjson
 import time
-import json
+from collections import OrderedDict
+from http.cookiejar import DefaultCookiePolicy
 from io import BytesIO
+from typing import BinaryIO, Optional
 from PIL import Image
+from requests.adapters import HTTPAdapter
+from streamlit.runtime.uploaded_file_manager import UploadedFile
+from urllib3.util.retry import Retry
 
 # ------------------------------
 # Helper Functions
 # ------------------------------
 
 
-def get_presigned_url(api_key: str, file_size: int, content_type: str) -> dict:
+@st.cache_resource
+def get_http() -> requests.Session:
+    """
+    Build the pooled HTTP session shared for the lifetime of the server process,
+    so every click reuses open keep-alive connections to LightX and S3.
+    """
+    session = requests.Session()
+    # urllib3 only retries idempotent methods, so the S3 PUT is retried but
+    # the LightX POSTs are not; that keeps a generation request from being
+    # submitted twice. The last response is returned rather than raised so
+    # callers can report the failure.
+    retries = Retry(total=3, backoff_factor=0.3,
+                    status_forcelist=[502, 503, 504], raise_on_status=False)
+    # One pool per host (LightX API and the S3 upload bucket)
+    session.mount("https://", HTTPAdapter(
+        pool_connections=2, pool_maxsize=4, max_retries=retries))
+    session.headers.update({"Content-Type": "application/json"})
+    # The session is shared by every browser session, so never keep cookies
+    session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+    return session
+
+
+def parse_json(response: requests.Response) -> dict:
+    """
+    Decode a LightX JSON response body with orjson.
+    """
+    return orjson.loads(response.content)
+
+# Maximum number of seconds to wait for a generation order to finish.
+MAX_POLL_WAIT = 30
+
+ORDER_STATUS_URL = "https://api.lightxeditor.com/external/api/v1/order-status"
+
+# Generation endpoint for each service option
+ENDPOINTS = {
+    "AI Avatar": "https://api.lightxeditor.com/external/api/v1/avatar",
+    "AI Cartoon": "https://api.lightxeditor.com/external/api/v1/cartoon"
+}
+
+# Number of uploads and outputs remembered per browser session
+CACHE_SIZE = 8
+
+# Upload content type for each image format accepted by LightX, keyed on
+# the format PIL reads from the image header. PIL reports JPEGs carrying a
+# multi-picture (MPF) segment, common from phone cameras, as "MPO".
+CONTENT_TYPES = {
+    "JPEG": "image/jpeg",
+    "MPO": "image/jpeg",
+    "PNG": "image/png"
+}
+
+# Allowed width/height range in pixels
+MIN_IMAGE_DIMENSION = 64
+MAX_IMAGE_DIMENSION = 8192
+
+# File extensions offered by the uploader
+UPLOAD_EXTENSIONS = ["jpg", "jpeg", "png"]
+
+
+def get_presigned_url(session: requests.Session, api_key: str, file_size: int, content_type: str) -> dict:
     """
     Call LightX's uploadImageUrl endpoint to get a presigned URL for uploading the image.
     """
     url = "https://api.lightxeditor.com/external/api/v2/uploadImageUrl"
-    headers = {
-        "Content-Type": "application/json",
-        "x-api-key": api_key
-    }
+    headers = {"x-api-key": api_key}
     data = {
         # Options: "maskedImageUrl", "imageUrl", "styleImageUrl"
         "uploadType": "maskedImageUrl",
         "size": file_size,
         "contentType": content_type
     }
-    response = requests.post(url, headers=headers, json=data)
-    return response.json()
+    response = session.post(url, headers=headers, json=data)
+    return parse_json(response)
 
 
-def upload_file_to_s3(presigned_url: str, file_bytes: bytes, content_type: str) -> bool:
+def upload_file_to_s3(session: requests.Session, presigned_url: str, file_obj: BinaryIO, content_type: str, file_size: int) -> bool:
     """
     Upload the image file to the provided presigned S3 URL.
+    The file object is streamed in chunks rather than buffered in memory.
     """
-    headers = {"Content-Type": content_type}
-    response = requests.put(presigned_url, headers=headers, data=file_bytes)
+    file_obj.seek(0)
+    headers = {
+        "Content-Type": content_type,
+        "Content-Length": str(file_size)
+    }
+    response = session.put(presigned_url, headers=headers, data=file_obj)
     return response.status_code == 200
 
 
-def request_generation(api_key: str, endpoint: str, image_url: str, text_prompt: str) -> dict:
+def request_generation(session: requests.Session, api_key: str, endpoint: str, image_url: str, text_prompt: str) -> dict:
     """
     Request AI generation (Avatar or Cartoon) from LightX.
     """
-    headers = {
-        "Content-Type": "application/json",
-        "x-api-key": api_key
-    }
+    headers = {"x-api-key": api_key}
     data = {
         "imageUrl": image_url,
         # Using same URL for style; adjust if needed.
         "styleImageUrl": image_url,
         "textPrompt": text_prompt
     }
-    response = requests.post(endpoint, headers=headers, json=data)
-    return response.json()
+    response = session.post(endpoint, headers=headers, json=data)
+    return parse_json(response)
 
 
-def check_order_status(api_key: str, order_id: str) -> dict:
+def check_order_status(session: requests.Session, api_key: str, order_id: str) -> dict:
     """
     Check the status of the generation order.
     """
-    url = "https://api.lightxeditor.com/external/api/v1/order-status"
-    headers = {
-        "Content-Type": "application/json",
-        "x-api-key": api_key
-    }
+    headers = {"x-api-key": api_key}
     data = {"orderId": order_id}
-    response = requests.post(url, headers=headers, data=json.dumps(data))
-    return response.json()
+    response = session.post(ORDER_STATUS_URL, headers=headers, json=data)
+    return parse_json(response)
+
+
+def get_session_cache(name: str) -> OrderedDict:
+    """
+    Return the named LRU cache stored in the user's session state.
+    """
+    return st.session_state.setdefault(name, OrderedDict())
+
+
+def cache_lookup(cache: OrderedDict, key: tuple) -> Optional[str]:
+    """
+    Return the cached value for key, marking it as recently used.
+    """
+    value = cache.get(key)
+    if value is not None:
+        cache.move_to_end(key)
+    return value
+
+
+def cache_store(cache: OrderedDict, key: tuple, value: str) -> None:
+    """
+    Store a value, evicting the least recently used entries beyond CACHE_SIZE.
+    """
+    cache[key] = value
+    cache.move_to_end(key)
+    while len(cache) > CACHE_SIZE:
+        cache.popitem(last=False)
+
+
+def show_uploaded_image(file_bytes: bytes) -> None:
+    """
+    Display the image submitted with the current generation.
+    """
+    st.subheader("Uploaded Image")
+    st.image(file_bytes, use_container_width=True)
+
+
+def start_generation(api_key: str, service_option: str, text_prompt: str,
+                     uploaded_file: Optional[UploadedFile]) -> None:
+    """
+    Validate the inputs, upload the image and submit the generation order.
+    The order is then polled by poll_order_status.
+    """
+    # A new click replaces any earlier order, preview or output
+    st.session_state.pop("pending_order", None)
+    st.session_state.pop("generation_result", None)
+    st.session_state.pop("uploaded_preview", None)
+
+    if not api_key:
+        st.error("Please enter your LightX API Key.")
+        return
+    if not uploaded_file:
+        st.error("Please upload an image.")
+        return
+
+    # Check file size before touching the image bytes
+    file_size = uploaded_file.size
+    if file_size > 2_097_152:
+        st.error("Image exceeds the 2MB limit. Please upload a smaller image.")
+        return
+    # UploadedFile wraps the received bytes in a BytesIO, so getvalue()
+    # hands back that same object; getbuffer() would have to copy it
+    file_bytes = uploaded_file.getvalue()
+
+    # Check format and dimensions from the image header; no pixels are decoded
+    try:
+        with Image.open(BytesIO(file_bytes)) as image:
+            width, height = image.size
+            image_format = image.format
+    except (OSError, Image.DecompressionBombError):
+        # OSError covers unidentified files as well as truncated headers
+        st.error("The uploaded file is not a readable image.")
+        return
+    if image_format not in CONTENT_TYPES:
+        st.error(
+            f"Unsupported image format: {image_format}. Please upload a JPG or PNG image.")
+        return
+    if (min(width, height) < MIN_IMAGE_DIMENSION
+            or max(width, height) > MAX_IMAGE_DIMENSION):
+        st.error(
+            f"Image is {width}x{height} pixels. Each side must be between "
+            f"{MIN_IMAGE_DIMENSION} and {MAX_IMAGE_DIMENSION} pixels.")
+        return
+
+    # Determine content type from the actual format, not the file extension
+    content_type = CONTENT_TYPES[image_format]
+
+    # Display the uploaded image and keep it for the reruns that follow
+    st.session_state["uploaded_preview"] = file_bytes
+    show_uploaded_image(file_bytes)
+
+    # Determine endpoint based on service selection
+    endpoint = ENDPOINTS[service_option]
+    session = get_http()
+
+    # Reuse an earlier output for the same image, service and prompt
+    image_hash = hashlib.blake2b(file_bytes, digest_size=16).hexdigest()
+    outputs = get_session_cache("outputs")
+    output_key = (image_hash, endpoint, text_prompt)
+    output_url = cache_lookup(outputs, output_key)
+    if output_url:
+        st.info("Showing the output previously generated for this image and prompt.")
+        st.session_state["generation_result"] = {
+            "service": service_option, "output_url": output_url}
+        return
+
+    # Reuse an earlier upload of the same image instead of re-uploading
+    uploaded_images = get_session_cache("uploaded_images")
+    upload_key = (image_hash, file_size, content_type)
+    final_image_url = cache_lookup(uploaded_images, upload_key)
+    presigned_url = None
+
+    # Progress updates are grouped in one status block so they reach the
+    # browser as a single element instead of one message per step
+    with st.status(f"Generating your {service_option}...", expanded=True) as progress:
+        if final_image_url:
+            progress.write("Reusing previously uploaded image.")
+        else:
+            # 1) Request presigned URL from LightX
+            progress.update(label="Requesting upload URL...")
+            presigned_response = get_presigned_url(
+                session, api_key, file_size, content_type)
+            if presigned_response.get("statusCode") != 2000:
+                progress.update(
+                    label="Failed to get presigned URL.", state="error")
+                progress.write(f"Response: {presigned_response}")
+                return
+
+            body = presigned_response.get("body", {})
+            presigned_url = body.get("uploadImage")
+            final_image_url = body.get(
+                "imageUrl") or body.get("maskedImageUrl")
+            if not presigned_url or not final_image_url:
+                progress.update(
+                    label="Missing upload URL or final image URL in the response.",
+                    state="error")
+                return
+
+        # 2) Upload image to S3 using the presigned URL
+        if presigned_url:
+            progress.update(label="Uploading image...")
+            if not upload_file_to_s3(
+                    session, presigned_url, uploaded_file, content_type, file_size):
+                progress.update(label="Image upload failed.", state="error")
+                return
+            cache_store(uploaded_images, upload_key, final_image_url)
+            progress.write("Image uploaded successfully!")
+
+        # 3) Request generation
+        progress.update(label=f"Requesting {service_option}...")
+        gen_response = request_generation(
+            session, api_key, endpoint, final_image_url, text_prompt)
+
+        if gen_response.get("statusCode") != 2000:
+            progress.update(
+                label=f"{service_option} request failed.", state="error")
+            progress.write(f"Response: {gen_response}")
+            return
+
+        order_id = gen_response.get("body", {}).get("orderId")
+        if not order_id:
+            progress.update(
+                label="No orderId received from the generation request.",
+                state="error")
+            return
+
+        # 4) Hand the order to the polling fragment
+        now = time.monotonic()
+        st.session_state["pending_order"] = {
+            "order_id": order_id,
+            "api_key": api_key,
+            "service": service_option,
+            "output_key": output_key,
+            "deadline": now + MAX_POLL_WAIT,
+            "next_check": now + 0.5,
+            "delay": 0.5,
+            "poll_count": 0,
+            "status_error": None
+        }
+        progress.update(
+            label=f"{service_option} requested.", state="complete", expanded=False)
+
+
+def finish_order(output_url: Optional[str] = None, error: Optional[str] = None) -> None:
+    """
+    Record the outcome of the pending order and rerun the full app to show it.
+    """
+    pending = st.session_state.pop("pending_order")
+    st.session_state["generation_result"] = {
+        "service": pending["service"],
+        "output_url": output_url,
+        "error": error
+    }
+    st.rerun()
+
+
+@st.fragment(run_every=1.0)
+def poll_order_status() -> None:
+    """
+    Check the pending order from session state, backing off from 0.5s up to
+    4s between checks. Only this fragment reruns on the timer, so the rest of
+    the page stays responsive while the order is processed.
+    """
+    pending = st.session_state.get("pending_order")
+    if not pending:
+        return
+    service_option = pending["service"]
+
+    if st.button("Cancel"):
+        finish_order(error="Generation cancelled.")
+        return
+
+    # Give up before sending another request once the deadline has passed
+    now = time.monotonic()
+    if now >= pending["deadline"]:
+        if pending["status_error"]:
+            finish_order(
+                error=f"Status check failed. Response: {pending['status_error']}")
+        else:
+            finish_order(error="Generation timed out. Please try again.")
+        return
+
+    if now >= pending["next_check"]:
+        pending["poll_count"] += 1
+        pending["next_check"] = now + pending["delay"]
+        pending["delay"] = min(pending["delay"] * 1.7, 4.0)
+        try:
+            status_response = check_order_status(
+                get_http(), pending["api_key"], pending["order_id"])
+        except (requests.RequestException, orjson.JSONDecodeError) as error:
+            # Network errors and non-JSON bodies (e.g. a 502 HTML page) count
+            # as failed checks, so the deadline above still ends the order
+            status_response = {"error": str(error)}
+        if status_response.get("statusCode") != 2000:
+            pending["status_error"] = status_response
+        else:
+            pending["status_error"] = None
+            status = status_response.get("body", {}).get("status")
+            if status == "active":
+                output_url = status_response.get("body", {}).get("output")
+                if output_url:
+                    cache_store(get_session_cache("outputs"),
+                                pending["output_key"], output_url)
+                    finish_order(output_url=output_url)
+                else:
+                    finish_order(
+                        error=f"{service_option} finished without an output image.")
+                return
+            elif status == "failed":
+                finish_order(error=f"{service_option} generation failed.")
+                return
+
+    with st.status(
+            f"Waiting for your {service_option} (check {pending['poll_count']})...",
+            state="running"):
+        if pending["status_error"]:
+            st.write(
+                f"Status check failed on attempt {pending['poll_count']}.")
+
+
+def show_generation_result() -> None:
+    """
+    Display the output (or error) of the last finished generation order.
+    """
+    result = st.session_state.get("generation_result")
+    if not result:
+        return
+    if result.get("error"):
+        st.error(result["error"])
+        return
+    st.subheader(f"Your {result['service']} Output")
+    st.image(result["output_url"], use_container_width=True)
 
 # ------------------------------
 # Main App
@@ -103,8 +436,7 @@ def main():
     api_key = st.text_input("Enter your LightX API Key", type="password")
 
     # Service selection: AI Avatar or AI Cartoon
-    service_option = st.radio("Select Service", options=[
-                              "AI Avatar", "AI Cartoon"])
+    service_option = st.radio("Select Service", options=list(ENDPOINTS))
 
     # Set default text prompt based on selection
     if service_option == "AI Avatar":
@@ -116,99 +448,20 @@ def main():
 
     # Image uploader
     uploaded_file = st.file_uploader(
-        "Upload your image (under 2MB)", type=["jpg", "jpeg", "png"])
+        "Upload your image (under 2MB)",
+        type=UPLOAD_EXTENSIONS)
 
     if st.button("Generate"):
-        if not api_key:
-            st.error("Please enter your LightX API Key.")
-            return
-        if not uploaded_file:
-            st.error("Please upload an image.")
-            return
-
-        # Read image bytes and check file size
-        file_bytes = uploaded_file.read()
-        file_size = len(file_bytes)
-        if file_size > 2_097_152:
-            st.error("Image exceeds the 2MB limit. Please upload a smaller image.")
-            return
-
-        # Determine content type from extension
-        filename = uploaded_file.name.lower()
-        content_type = "image/png" if filename.endswith(
-            ".png") else "image/jpeg"
-
-        # Display the uploaded image
-        image = Image.open(BytesIO(file_bytes)).convert("RGB")
-        st.subheader("Uploaded Image")
-        st.image(image, use_container_width=True)
-
-        # 1) Request presigned URL from LightX
-        presigned_response = get_presigned_url(
-            api_key, file_size, content_type)
-        if presigned_response.get("statusCode") != 2000:
-            st.error(
-                f"Failed to get presigned URL. Response: {presigned_response}")
-            return
-
-        body = presigned_response.get("body", {})
-        presigned_url = body.get("uploadImage")
-        final_image_url = body.get("imageUrl") or body.get("maskedImageUrl")
-        if not presigned_url or not final_image_url:
-            st.error("Missing upload URL or final image URL in the response.")
-            return
-
-        # 2) Upload image to S3 using the presigned URL
-        if not upload_file_to_s3(presigned_url, file_bytes, content_type):
-            st.error("Image upload failed.")
-            return
-        st.success("Image uploaded successfully!")
-
-        # 3) Determine endpoint based on service selection
-        if service_option == "AI Avatar":
-            endpoint = "https://api.lightxeditor.com/external/api/v1/avatar"
-        else:
-            endpoint = "https://api.lightxeditor.com/external/api/v1/cartoon"
-
-        gen_response = request_generation(
-            api_key, endpoint, final_image_url, text_prompt)
-        if gen_response.get("statusCode") != 2000:
-            st.error(
-                f"{service_option} request failed. Response: {gen_response}")
-            return
-
-        order_id = gen_response.get("body", {}).get("orderId")
-        if not order_id:
-            st.error("No orderId received from the generation request.")
-            return
-
-        # 4) Poll for order status (up to 5 retries, every 3 seconds)
-        poll_count = 0
-        max_retries = 5
-        output_url = None
-
-        while poll_count < max_retries:
-            poll_count += 1
-            time.sleep(3)
-            status_response = check_order_status(api_key, order_id)
-            if status_response.get("statusCode") != 2000:
-                st.warning(f"Status check failed on attempt {poll_count}.")
-                continue
-            status = status_response.get("body", {}).get("status")
-            if status == "active":
-                output_url = status_response.get("body", {}).get("output")
-                break
-            elif status == "failed":
-                st.error(f"{service_option} generation failed.")
-                return
-
-        if not output_url:
-            st.error("Generation timed out. Please try again.")
-            return
-
-        # 5) Display final output image
-        st.subheader(f"Your {service_option} Output")
-        st.image(output_url, use_container_width=True)
+        start_generation(api_key, service_option, text_prompt, uploaded_file)
+    elif "uploaded_preview" in st.session_state:
+        # Polling and completion reruns happen without the click, so show
+        # the submitted image again next to its output
+        show_uploaded_image(st.session_state["uploaded_preview"])
+
+    # 5) Poll the pending order, then display the final output image
+    if "pending_order" in st.session_state:
+        poll_order_status()
+    show_generation_result()
 
 
 if __name__ == "__main__":